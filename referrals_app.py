@@ -1,11 +1,24 @@
+import glob
 import io
 import os
+import shutil
+import tempfile
+import time
 import calendar
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pacsv
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
 import streamlit as st
+import xlsxwriter
 import yaml
 import streamlit_authenticator as stauth
+from streamlit.runtime.uploaded_file_manager import UploadedFile
 from datetime import date, datetime
+from pandas.api.types import union_categoricals
 
 # =========================
 # 🔐 AUTHENTICATION (YAML in Secrets)
@@ -66,11 +79,6 @@ except Exception as e:
 # =========================
 # App helpers / utilities
 # =========================
-def list_years(master_df):
-    if master_df.empty:
-        return []
-    return sorted({str(m)[:4] for m in master_df["month"].dropna()})
-
 def months_in_year(year, through_month=None):
     """Return ['YYYY-01', ...] up to through_month (1–12). If None, full year."""
     ym = []
@@ -87,78 +95,447 @@ The app will build a **Referral Source × Month** table. New sources automatical
 
 # ---------- Storage paths ----------
 DATA_DIR = "data"
-MASTER_PATH = os.path.join(DATA_DIR, "referrals_master.csv")
-os.makedirs(DATA_DIR, exist_ok=True)
+# Hive-partitioned Parquet dataset: data/master/year=YYYY/batch-<batch_id>-*.parquet, one set of
+# files per upload (rows without a batch_id go to unbatched-*.parquet)
+MASTER_DIR = os.path.join(DATA_DIR, "master")
+# Where a full rewrite parks the previous MASTER_DIR while swapping the new one in
+PREVIOUS_DIR = os.path.join(DATA_DIR, "master.old")
+LEGACY_CSV_PATH = os.path.join(DATA_DIR, "referrals_master.csv")
+# Uncompressed Arrow IPC copy of the whole master: memory-mapped on a cold start instead of
+# decoding every Parquet fragment. Rebuilt on the first full read after the dataset changes.
+SNAPSHOT_PATH = os.path.join(DATA_DIR, "master_snapshot.arrow")
+# Rewritten after every write; its content is the cache key for everything read from MASTER_DIR
+VERSION_PATH = os.path.join(DATA_DIR, "master.version")
+# The plain text column (referred_person) loads as string[pyarrow]: one UTF-8 buffer instead of
+# a Python object per row, which also makes st.cache_data's copies cheap
+ARROW_STRINGS = {pa.string(): pd.StringDtype("pyarrow"), pa.large_string(): pd.StringDtype("pyarrow")}
+MASTER_PARTITIONING = ds.partitioning(pa.schema([("year", pa.int16())]), flavor="hive")
+# What every read returns, in this column order
+MASTER_SCHEMA = pa.schema([
+    ("referred_person", pa.string()),
+    ("referral_source", pa.dictionary(pa.int32(), pa.string())),
+    ("month", pa.dictionary(pa.int32(), pa.string())),
+    ("batch_id", pa.dictionary(pa.int32(), pa.string())),
+    ("year", pa.int16()),
+    ("month_num", pa.int8()),
+])
+@st.cache_resource(show_spinner=False)
+def _recover_master_dir():
+    """Once per process, not per rerun: another session may be between a rewrite's two renames.
+
+    A rewrite interrupted there (crash, restart) leaves the last complete master in PREVIOUS_DIR.
+    """
+    if not os.path.isdir(MASTER_DIR) and os.path.isdir(PREVIOUS_DIR):
+        os.replace(PREVIOUS_DIR, MASTER_DIR)
+    os.makedirs(MASTER_DIR, exist_ok=True)
+
+_recover_master_dir()
 
 # ---------- Utilities ----------
-def load_master():
-    if os.path.exists(MASTER_PATH):
-        try:
-            df = pd.read_csv(MASTER_PATH)
-            # Ensure required columns exist
-            for col in ["referred_person", "referral_source", "month"]:
-                if col not in df.columns:
-                    df[col] = pd.Series(dtype="object")
-            # Optional column for rollback
-            if "batch_id" not in df.columns:
-                df["batch_id"] = pd.NA
-            # Coerce month to YYYY-MM strings
-            df["month"] = df["month"].astype(str).str.slice(0, 7)
-            return df[["referred_person", "referral_source", "month", "batch_id"]]
-        except Exception:
-            pass
-    # Empty master
-    return pd.DataFrame(columns=["referred_person", "referral_source", "month", "batch_id"])
+def list_years():
+    """Years (ints) in the master, taken from the year=YYYY partition names (no data is read)."""
+    return sorted(int(d.split("=", 1)[1]) for d in os.listdir(MASTER_DIR) if d.startswith("year="))
 
-def save_master(df):
+def master_mtime():
+    """When the master last changed, read from the stamp every write leaves (no directory scan).
+
+    0.0 until the first write.
+    """
+    try:
+        with open(VERSION_PATH) as f:
+            return float(f.read())
+    except (FileNotFoundError, ValueError):
+        return 0.0
+
+def _stamp_master():
+    """Record a new master_mtime(); strictly increasing even within one clock tick."""
+    stamp = max(time.time(), master_mtime() + 1e-6)
+    # Unique temp name, so sessions writing at the same time don't share one
+    with tempfile.NamedTemporaryFile("w", dir=DATA_DIR, suffix=".version.tmp", delete=False) as f:
+        f.write(repr(stamp))
+    os.replace(f.name, VERSION_PATH)
+
+def _read_snapshot(mtime):
+    """Whole master from the Arrow IPC snapshot, or None if it is missing, unreadable, older
+    than `mtime` or not in MASTER_SCHEMA (the caller then rebuilds it from the dataset)."""
+    try:
+        with pa.memory_map(SNAPSHOT_PATH) as source:
+            table = pa.ipc.open_file(source).read_all()
+            if (table.schema.metadata or {}).get(b"master_mtime") != repr(mtime).encode():
+                return None
+            if not table.schema.remove_metadata().equals(MASTER_SCHEMA):
+                return None
+            return table.to_pandas(types_mapper=ARROW_STRINGS.get)
+    except (OSError, pa.ArrowInvalid):
+        return None
+
+def _write_snapshot(table, mtime):
+    """Mirror a full read of the dataset to SNAPSHOT_PATH, tagged with the mtime it reflects."""
+    # The IPC file format needs one dictionary per column across all fragments
+    table = table.unify_dictionaries()
+    table = table.replace_schema_metadata({**(table.schema.metadata or {}), b"master_mtime": repr(mtime).encode()})
+    # A unique temp name per write: two sessions doing a cold read at once must not share one
+    with tempfile.NamedTemporaryFile(dir=DATA_DIR, suffix=".arrow.tmp", delete=False) as tmp:
+        with pa.ipc.new_file(tmp, table.schema) as writer:
+            writer.write_table(table)
+    os.replace(tmp.name, SNAPSHOT_PATH)
+
+@st.cache_data(show_spinner=False)
+def _load_master_cached(path, mtime, year=None):
+    """Read the master dataset, or only one year's partition. `mtime` is only part of the cache key."""
+    if year is None:
+        df = _read_snapshot(mtime)
+        if df is None:
+            table = pq.read_table(path, schema=MASTER_SCHEMA, partitioning=MASTER_PARTITIONING)
+            _write_snapshot(table, mtime)
+            df = table.to_pandas(types_mapper=ARROW_STRINGS.get)
+    else:
+        table = pq.read_table(path, schema=MASTER_SCHEMA, filters=[("year", "=", year)],
+                              partitioning=MASTER_PARTITIONING)
+        df = table.to_pandas(types_mapper=ARROW_STRINGS.get)
+    # Every fragment carries the full schema: _write_fragments, the only writer (the CSV migration included), always sets it
+    return df
+
+def load_master(year=None):
+    """Whole master, or just the rows for `year` (an int, as list_years() gives) when given."""
+    if list_years():
+        mtime = master_mtime()
+        # This session's last write is already in memory; reuse it while nothing newer is on disk
+        held = st.session_state.get("master")
+        if year is None and held is not None and held[0] == mtime:
+            return held[1]
+        try:
+            df = _load_master_cached(MASTER_DIR, mtime, year)
+        except Exception as e:
+            # Never carry on with an empty master here: the next save would overwrite the real data
+            st.error(f"Could not read the master data in {MASTER_DIR}: {e}")
+            st.stop()
+        if year is None:
+            st.session_state["master"] = (mtime, df)
+        return df
+    # Empty master, with the same dtypes a read gives (categorical source/month/batch_id included)
+    return MASTER_SCHEMA.empty_table().to_pandas(types_mapper=ARROW_STRINGS.get)
+
+def _as_category(s):
+    """s as a categorical with plain object categories (what the Parquet reader returns), so
+    union_categoricals can join it with a loaded master even when s was string[pyarrow]."""
+    c = s.astype("category")
+    return pd.Series(pd.Categorical.from_codes(c.cat.codes, c.cat.categories.astype(object)), index=s.index)
+
+def _write_fragments(df, replace=False):
+    """Write df into its year partitions as new part files; existing files are left alone
+    unless `replace`, in which case df becomes the whole master.
+
+    Files are written to a staging directory of this call's own and moved into place with
+    os.replace, so a crash mid-write never leaves a partial file, or a half-deleted master, in
+    MASTER_DIR, and concurrent sessions never touch each other's staged files.
+    Returns the rows as written (same dtypes and columns load_master() gives back).
+    """
     # Save a stable column order
     cols = ["referred_person", "referral_source", "month", "batch_id"]
     for c in cols:
         if c not in df.columns:
             df[c] = pd.NA
-    df[cols].to_csv(MASTER_PATH, index=False)
+    # Low-cardinality columns go to Parquet dictionary-encoded and come back as categoricals.
+    # Explicit string types keep every fragment's schema identical, even for all-NA columns.
+    out = df[cols].astype({"referred_person": "string[pyarrow]"})
+    for col in ["referral_source", "month", "batch_id"]:
+        out[col] = _as_category(out[col])
+    # Integer year (partition key) and month number, so Explore filters compare ints, not strings
+    out["year"] = out["month"].str[:4].astype("int16")
+    out["month_num"] = out["month"].str[5:7].astype("int8")
+    staging_dir = tempfile.mkdtemp(prefix="master-", suffix=".tmp", dir=DATA_DIR)
+    try:
+        if len(out):
+            stamp = datetime.now().strftime("%Y%m%dT%H%M%S%f")
+            # Files never mix uploads, so undoing one is a file delete (see delete_batch)
+            for batch_id, rows in out.groupby("batch_id", observed=True, dropna=False, sort=False):
+                name = "unbatched" if pd.isna(batch_id) else f"batch-{batch_id}"
+                rows.to_parquet(staging_dir, partition_cols=["year"], compression="zstd", index=False,
+                                basename_template=f"{name}-{stamp}-{{i}}.parquet")
+        if replace:
+            shutil.rmtree(PREVIOUS_DIR, ignore_errors=True)
+            os.replace(MASTER_DIR, PREVIOUS_DIR)
+            os.replace(staging_dir, MASTER_DIR)
+            shutil.rmtree(PREVIOUS_DIR)
+        else:
+            for part in os.listdir(staging_dir):
+                os.makedirs(os.path.join(MASTER_DIR, part), exist_ok=True)
+                for name in os.listdir(os.path.join(staging_dir, part)):
+                    os.replace(os.path.join(staging_dir, part, name), os.path.join(MASTER_DIR, part, name))
+    finally:
+        # Gone already after a successful move; otherwise drop what a failed write staged
+        shutil.rmtree(staging_dir, ignore_errors=True)
+    _stamp_master()
+    _clear_data_caches()
+    return out
+
+def _clear_data_caches():
+    """Drop everything cached from the master: old entries are keyed on a version that can no
+    longer be hit, so they would only hold memory. The upload caches are not derived from the
+    master and are bounded by max_entries instead."""
+    for cached in (_load_master_cached, compute_period, distinct_values, to_csv_bytes, to_excel_bytes):
+        cached.clear()
+
+def save_master(df):
+    """Replace the whole master with df (used for deletes and clearing)."""
+    written = _write_fragments(df, replace=True)
+    st.session_state["master"] = (master_mtime(), written.reset_index(drop=True))
+
+def append_master(df_new):
+    """Add rows without rewriting history: cost scales with the upload, not the master."""
+    held = st.session_state.get("master")
+    up_to_date = held is not None and held[0] == master_mtime()
+    written = _write_fragments(df_new)
+    if up_to_date and held[1].empty:
+        # Nothing to extend (e.g. right after Clear ALL); concat with an empty frame is deprecated
+        st.session_state["master"] = (master_mtime(), written.reset_index(drop=True))
+    elif up_to_date:
+        # Extend the in-memory master instead of re-reading it; union keeps the columns categorical
+        merged = pd.concat([held[1], written], ignore_index=True)
+        for col in ["referral_source", "month", "batch_id"]:
+            merged[col] = union_categoricals([held[1][col].astype("category"), written[col]])
+        st.session_state["master"] = (master_mtime(), merged)
+
+def delete_batch(batch_id):
+    """Undo one upload by removing its part files; the rest of the master is not rewritten."""
+    master = load_master()
+    keep = master[(master["batch_id"] != batch_id).fillna(True)].reset_index(drop=True)
+    for path in glob.glob(os.path.join(MASTER_DIR, "year=*", f"batch-{batch_id}-*.parquet")):
+        os.remove(path)
+        # Drop a partition once its last file is gone, so list_years() stops offering the year
+        if not os.listdir(os.path.dirname(path)):
+            os.rmdir(os.path.dirname(path))
+    _stamp_master()
+    _clear_data_caches()
+    st.session_state["master"] = (master_mtime(), keep)
+
+def migrate_legacy_master():
+    """One-time move of the older CSV master into MASTER_DIR; the CSV is kept as .bak.
+
+    The move writes the full schema, so loads never have to patch it up.
+    """
+    if list_years():
+        return
+    if not os.path.exists(LEGACY_CSV_PATH):
+        return
+    df = pd.read_csv(LEGACY_CSV_PATH, dtype={"batch_id": "string"})
+    for col in ["referred_person", "referral_source", "month"]:
+        if col not in df.columns:
+            df[col] = pd.Series(dtype="object")
+    # Coerce month to YYYY-MM strings
+    df["month"] = df["month"].astype(str).str.slice(0, 7)
+    save_master(df)
+    os.replace(LEGACY_CSV_PATH, LEGACY_CSV_PATH + ".bak")
+
+MONTH_FORMATS = ("%Y-%m", "%Y/%m", "%Y-%m-%d", "%d/%m/%Y", "%m/%d/%Y", "%b %Y", "%B %Y")
 
 def normalize_month(val):
     """Return YYYY-MM string for month input that may be a date, string, or pandas Timestamp."""
-    if pd.isna(val):
-        return None
-    if isinstance(val, (pd.Timestamp, datetime)):
-        return val.strftime("%Y-%m")
-    s = str(val).strip()
-    for fmt in ("%Y-%m", "%Y/%m", "%Y-%m-%d", "%d/%m/%Y", "%m/%d/%Y", "%b %Y", "%B %Y"):
+    # Scalar wrapper so single values and whole columns go through the same parser
+    out = normalize_month_series(pd.Series([val], dtype=object)).iloc[0]
+    return None if pd.isna(out) else out
+
+def normalize_month_series(s):
+    """Vectorized normalize_month: YYYY-MM strings for a whole column (NaN where unparseable).
+
+    Only the distinct values are parsed (an upload repeats a handful of months across
+    every row) and the results are mapped back through the factorized codes.
+    """
+    codes, uniques = pd.factorize(s)
+    if not len(uniques):
+        return pd.Series(np.nan, index=s.index, dtype=object)
+    months = _parse_months(pd.Series(uniques)).to_numpy(dtype=object)
+    out = months[codes]
+    out[codes < 0] = np.nan
+    return pd.Series(out, index=s.index, dtype=object)
+
+def _parse_months(s):
+    """Parse a column to YYYY-MM strings (NaN where unparseable).
+
+    Tries MONTH_FORMATS in order, one C-level pass per format over the still-unparsed
+    values, then lets pandas infer whatever is left.
+    """
+    if pd.api.types.is_datetime64_any_dtype(s):
+        return s.dt.strftime("%Y-%m")
+    text = s.astype("string").str.strip()
+    parsed = pd.Series(pd.NaT, index=s.index, dtype="datetime64[ns]")
+    for fmt in MONTH_FORMATS + ("mixed",):
+        todo = parsed.isna() & text.notna()
+        if not todo.any():
+            break
+        parsed[todo] = pd.to_datetime(text[todo], format=fmt, errors="coerce")
+    return parsed.dt.strftime("%Y-%m")
+
+@st.cache_data(show_spinner=False)
+def compute_period(mtime, year, use_ytd):
+    """Rows, pivot, monthly totals and per-source averages for one year (YTD or full).
+
+    `mtime` is only part of the cache key.
+    """
+    # Read only the selected year's partition
+    master_year = load_master(year)
+
+    # Determine YTD cutoff based on data
+    cutoff_month = None
+    if use_ytd:
+        month_num = master_year["month_num"].to_numpy()
+        cutoff_month = int(month_num.max()) if len(month_num) else 12
+        master_year = master_year[month_num <= cutoff_month]
+
+    # Columns cover every month Jan..(cutoff), zero-filled
+    full_months = months_in_year(year, cutoff_month)
+    pivot = build_pivot(master_year, full_months)
+    # Column sums don't depend on row order, so they are computed once here, not per sort
+    counts = pivot.to_numpy()
+    totals = pd.DataFrame([counts.sum(axis=0)], index=["TOTALS"], columns=pivot.columns)
+    # The pivot already holds exactly full_months, zero-filled, so the row mean is the average
+    averages = pd.DataFrame({"avg_referrals_per_month": counts.mean(axis=1)}, index=pivot.index)
+    averages = averages.sort_values("avg_referrals_per_month", ascending=False)
+    return master_year, pivot, totals, averages
+
+def strip_text(s, blank_as_na=False):
+    """`s.astype("string").str.strip()` with the trim done by Arrow's UTF-8 kernel; returns string[pyarrow].
+
+    Missing cells stay missing; with `blank_as_na`, so do cells that are empty once trimmed.
+    """
+    trimmed = pc.utf8_trim_whitespace(pa.array(s.astype("string[pyarrow]")))
+    if blank_as_na:
+        trimmed = pc.if_else(pc.equal(trimmed, ""), pa.scalar(None, pa.string()), trimmed)
+    return pd.Series(pd.arrays.ArrowStringArray(trimmed), index=s.index)
+
+def build_pivot(df, months):
+    """Referral source × month counts for `months` (zero-filled), sources sorted by name.
+
+    Both keys are reduced to categorical codes and counted with a single np.bincount over
+    `source_code * n_months + month_code`, so no long-format frame or pivot is built.
+    """
+    src = df["referral_source"].astype("category")
+    mon = pd.Categorical(df["month"], categories=months, ordered=True)
+    codes_s = src.cat.codes.to_numpy()
+    codes_m = mon.codes
+    # Code -1 marks a blank source or a month outside `months`
+    valid = (codes_s >= 0) & (codes_m >= 0)
+    if not valid.all():
+        codes_s, codes_m = codes_s[valid], codes_m[valid]
+    n_src, n_months = len(src.cat.categories), len(months)
+    flat = codes_s.astype(np.int64) * n_months + codes_m
+    counts = np.bincount(flat, minlength=n_src * n_months).reshape(n_src, n_months)
+    # Columns are already in `months` order (ordered categorical). Pick rows the same way:
+    # drop categories unused in this period and put the rest in name order in one gather,
+    # instead of filtering and then sort_index() on the frame.
+    names = src.cat.categories.to_numpy()
+    used = np.flatnonzero(counts.any(axis=1))
+    rows = used[np.argsort(names[used], kind="stable")]
+    return pd.DataFrame(counts[rows],
+                        index=pd.Index(names[rows], name="referral_source"),
+                        columns=pd.Index(months, name="month"))
+
+@st.cache_data(show_spinner=False)
+def distinct_values(mtime, col):
+    """Sorted distinct non-blank values of a master column. `mtime` is only part of the cache key."""
+    return sorted(load_master()[col].dropna().unique().tolist())
+
+@st.cache_data(show_spinner=False)
+def to_csv_bytes(key, _df, index=True):
+    """CSV bytes of `_df`. Only `key` (what the frame was built from) is hashed, never the rows."""
+    return _df.to_csv(index=index).encode("utf-8")
+
+def _write_sheet(workbook, name, df, index, chunk_rows=10_000):
+    """Write df row by row; in constant_memory mode each finished row is flushed to disk.
+
+    pandas' to_excel fills cells column by column, which constant_memory silently drops,
+    so rows are written here directly, converting a chunk at a time to Python values.
+    """
+    frame = df.reset_index() if index else df
+    ws = workbook.add_worksheet(name)
+    ws.write_row(0, 0, [str(c) for c in frame.columns], workbook.add_format({"bold": True}))
+    for start in range(0, len(frame), chunk_rows):
+        chunk = frame.iloc[start:start + chunk_rows].astype(object)
+        chunk = chunk.where(chunk.notna(), None)
+        for r, row in enumerate(chunk.itertuples(index=False, name=None), start=start + 1):
+            ws.write_row(r, 0, row)
+
+@st.cache_data(show_spinner=False)
+def to_excel_bytes(key, _pivot_df, _master_df, _averages_df):
+    """Pivot/Master/Averages workbook; cached on `key` alone, like to_csv_bytes."""
+    output = io.BytesIO()
+    workbook = xlsxwriter.Workbook(output, {"constant_memory": True})
+    _write_sheet(workbook, "Pivot", _pivot_df, index=True)
+    _write_sheet(workbook, "Master (filtered)", _master_df, index=False)
+    _write_sheet(workbook, "Averages", _averages_df, index=True)
+    workbook.close()
+    return output.getvalue()
+
+def _upload_key(uploaded):
+    # file_id is unique per upload, so the file bytes never need to be hashed
+    return (uploaded.file_id, uploaded.name, uploaded.size)
+
+@st.cache_data(show_spinner=False, max_entries=4, hash_funcs={UploadedFile: _upload_key})
+def list_sheets(uploaded):
+    """Sheet names of an uploaded workbook, without parsing any sheet."""
+    uploaded.seek(0)
+    return pd.ExcelFile(uploaded, engine="calamine").sheet_names
+
+@st.cache_data(show_spinner=False, max_entries=4, hash_funcs={UploadedFile: _upload_key})
+def read_upload(uploaded, sheet):
+    """Parse one sheet of an uploaded workbook (`sheet` is ignored for CSV)."""
+    uploaded.seek(0)
+    if uploaded.name.lower().endswith(".csv"):
+        # Arrow's multithreaded parser; repetitive text columns come back dictionary-encoded
+        # (category), the rest as string[pyarrow]
         try:
-            return datetime.strptime(s, fmt).strftime("%Y-%m")
-        except Exception:
+            table = pacsv.read_csv(uploaded, convert_options=pacsv.ConvertOptions(auto_dict_encode=True))
+            # Arrow falls back to binary for non-UTF-8 text
+            value_types = [f.type.value_type if pa.types.is_dictionary(f.type) else f.type for f in table.schema]
+            if (len(set(table.column_names)) == table.num_columns
+                    and not any(pa.types.is_binary(t) for t in value_types)):
+                return table.to_pandas(types_mapper=ARROW_STRINGS.get)
+        except pa.ArrowInvalid:
             pass
-    try:
-        parsed = pd.to_datetime(s, errors="coerce")
-        return parsed.strftime("%Y-%m") if not pd.isna(parsed) else None
-    except Exception:
-        return None
+        # Ragged rows, non-UTF-8 text or duplicate headers: let pandas handle (or report) it
+        uploaded.seek(0)
+        return pd.read_csv(uploaded)
+    return pd.read_excel(uploaded, sheet_name=sheet, engine="calamine")
+
+# Runs after the cached readers are defined, since a migration write clears them
+migrate_legacy_master()
+
+# Loaded once per run; the sidebar and row editor share it, and an append refreshes it
+master = load_master()
 
 # ---------- Sidebar ----------
 with st.sidebar:
     st.subheader("Master Data")
-    master = load_master()
     st.caption(f"Records in master: **{len(master):,}**")
 
     # Undo (delete) a past upload by batch_id
-    batches = master.dropna(subset=["batch_id"])
-    if len(batches):
+    # For a categorical, sort=True follows category order (file discovery order after a read),
+    # not the ids, so the newest-first order is taken from the names below
+    ids, names = pd.factorize(master["batch_id"])
+    if len(names):
         st.markdown("**Undo a past upload (batch):**")
-        agg = (batches
-               .groupby("batch_id")
-               .agg(rows=("referred_person", "size"),
-                    months=("month", lambda s: ", ".join(sorted(pd.Series(s).dropna().unique())[:6]))))
-        agg = agg.sort_index(ascending=False)
-        batch_labels = [f"{idx} • {row.rows} rows • {row.months}" for idx, row in agg.iterrows()]
-        batch_ids = list(agg.index)
+        # Same integer-code bincounts as build_pivot: rows per batch and the months each batch touches,
+        # with no per-group Python
+        month = master["month"].astype("category")
+        m_codes = month.cat.codes.to_numpy()
+        n_b, n_m = len(names), len(month.cat.categories)
+        has_id = ids >= 0
+        rows = np.bincount(ids[has_id], minlength=n_b)
+        both = has_id & (m_codes >= 0)
+        seen = np.bincount(ids[both].astype(np.int64) * n_m + m_codes[both], minlength=n_b * n_m).reshape(n_b, n_m)
+        by_name = np.argsort(month.cat.categories.astype(str))
+        month_names = month.cat.categories.astype(str)[by_name]
+        # batch_ids are timestamps, so descending by name is newest first
+        newest_first = np.argsort(np.asarray(names, dtype=str))[::-1]
+        batch_labels = [f"{names[i]} • {rows[i]} rows • {', '.join(month_names[seen[i, by_name] > 0][:6])}"
+                        for i in newest_first]
+        batch_ids = [names[i] for i in newest_first]
         sel_label = st.selectbox("Select batch to delete", batch_labels, key="sel_batch") if len(batch_labels) else None
         if sel_label:
             sel_id = batch_ids[batch_labels.index(sel_label)]
             if st.button("🗑 Delete selected batch", key="delete_batch_btn"):
-                master = master[~(master["batch_id"] == sel_id)]
-                save_master(master)
+                delete_batch(sel_id)
                 st.success(f"Deleted batch {sel_id}.")
                 st.stop()
 
@@ -177,16 +554,11 @@ st.header("1) Upload Monthly List")
 uploaded = st.file_uploader("Drop an Excel/CSV file", type=["xlsx", "xls", "csv"])
 
 if uploaded is not None:
-    # Read file
-    if uploaded.name.lower().endswith(".csv"):
-        candidates = {"CSV": pd.read_csv(uploaded)}
-    else:
-        xl = pd.ExcelFile(uploaded)
-        candidates = {s: xl.parse(s) for s in xl.sheet_names}
-
-    # Choose sheet
-    sheet = st.selectbox("Choose a sheet", list(candidates.keys()))
-    data = candidates[sheet].copy()
+    # Choose sheet (only the chosen one is parsed)
+    sheet_names = ["CSV"] if uploaded.name.lower().endswith(".csv") else list_sheets(uploaded)
+    sheet = st.selectbox("Choose a sheet", sheet_names)
+    # st.cache_data already hands back a private copy, and everything below only reads columns
+    data = read_upload(uploaded, sheet)
 
     st.write("Preview:")
     st.dataframe(data.head(20), use_container_width=True)
@@ -223,45 +595,42 @@ if uploaded is not None:
         chosen_month = f"{year_num}-{month_num:02d}"
     else:
         month_col = st.selectbox("Column containing the month/date", cols, index=2 if len(cols) > 2 else 0)
-        tmp = data[month_col].head(10).apply(normalize_month)
+        tmp = normalize_month_series(data[month_col].head(10))
         st.caption("Conversion preview (first 10 rows): " + ", ".join([str(x) for x in tmp.tolist()]))
 
     # Append button
     if st.button("➕ Append to Master"):
         df_new = pd.DataFrame({
-            "referred_person": data[ref_person_col].astype(str).str.strip(),
-            "referral_source": data[source_col].astype(str).str.strip()
+            "referred_person": strip_text(data[ref_person_col]),
+            "referral_source": strip_text(data[source_col], blank_as_na=True)
         })
         if month_mode == "Pick a month for all rows":
             df_new["month"] = chosen_month
         else:
-            df_new["month"] = data[month_col].apply(normalize_month)
+            df_new["month"] = normalize_month_series(data[month_col])
 
-        # Drop blanks / bad
+        # Drop blanks / bad (blank sources are already NA, so one dropna covers both)
         before = len(df_new)
         df_new = df_new.dropna(subset=["referral_source", "month"])
-        df_new = df_new[df_new["referral_source"] != ""]
         after = len(df_new)
 
         # Tag this upload as a batch for rollback
         batch_id = datetime.now().strftime("%Y%m%d%H%M%S")
         df_new["batch_id"] = batch_id
 
+        append_master(df_new)
         master = load_master()
-        master = pd.concat([master, df_new], ignore_index=True)
-        save_master(master)
         st.success(f"Appended {after} rows (dropped {before - after} incomplete rows). Batch ID: {batch_id}")
 
 # ---------- Explore & Download ----------
 st.header("2) Explore & Download Results")
-master = load_master()
+years = list_years()
 
-if len(master) == 0:
+if not years:
     st.info("Upload at least one monthly file to see results.")
 else:
     # Year filter + YTD (YTD ends at latest month with DATA, not today)
-    years = list_years(master)
-    latest_year = years[-1] if years else None
+    latest_year = years[-1]
 
     col_y1, col_y2 = st.columns([2, 1])
     with col_y1:
@@ -269,43 +638,14 @@ else:
     with col_y2:
         use_ytd = st.checkbox("Use Year-to-Date (ends at latest month with data)", value=True)
 
-    # Filter to selected year
-    year_mask = master["month"].str.startswith(year_choice)
-    master_year = master[year_mask].copy()
-
-    # Determine YTD cutoff based on data
-    cutoff_month = None
-    if use_ytd:
-        months_for_year = (
-            master.loc[master["month"].str.startswith(year_choice), "month"]
-            .str[-2:].astype(int).sort_values()
-        )
-        cutoff_month = int(months_for_year.iloc[-1]) if len(months_for_year) else 12
-        master_year = master_year[master_year["month"].str[-2:].astype(int) <= cutoff_month]
+    # Filter + pivot are cached per data version and period; sorting below works off the result
+    period = (master_mtime(), year_choice, use_ytd)
+    master_year, pivot, totals, avg_per_source = compute_period(*period)
 
     if master_year.empty:
         st.info("No data for the selected year/period yet.")
     else:
-        # Build pivot for the selected period
-        pivot = (
-            master_year
-            .groupby(["referral_source", "month"], dropna=False)
-            .size()
-            .reset_index(name="count")
-            .pivot(index="referral_source", columns="month", values="count")
-            .fillna(0)
-            .astype(int)
-            .sort_index()
-        )
-
-        # Ensure columns cover all months in the period (zero-fill)
-        full_months = months_in_year(year_choice, cutoff_month)
-        for m in full_months:
-            if m not in pivot.columns:
-                pivot[m] = 0
-        pivot = pivot[full_months]  # Jan..(cutoff)
-
-        # Sorting controls
+        # Sorting controls (runs on the cached pivot, never on raw rows)
         st.subheader("Sorting")
         months = ["(Alphabetical)"] + list(pivot.columns)
         sort_choice = st.selectbox("Sort referral sources by:", months, index=0)
@@ -322,56 +662,48 @@ else:
         st.dataframe(pivot_view, use_container_width=True)
 
         # Monthly totals row
-        totals = pd.DataFrame([pivot_view.sum(axis=0)], index=["TOTALS"])
         st.write("**Monthly totals across all sources:**")
         st.dataframe(totals, use_container_width=True)
 
         # Average per referral source across the shown months (includes zeros)
         st.subheader(f"Average referrals per source — {title_suffix}")
-        avg_per_source = pivot[full_months].mean(axis=1).to_frame(name="avg_referrals_per_month")
-        avg_per_source_sorted = avg_per_source.sort_values("avg_referrals_per_month", ascending=False)
-        st.dataframe(avg_per_source_sorted, use_container_width=True)
-
-        # Downloads (filtered to current year/period)
-        def to_excel_bytes(pivot_df, master_df, averages_df):
-            output = io.BytesIO()
-            with pd.ExcelWriter(output, engine="xlsxwriter") as writer:
-                pivot_df.to_excel(writer, sheet_name="Pivot")
-                master_df.to_excel(writer, sheet_name="Master (filtered)", index=False)
-                averages_df.to_excel(writer, sheet_name="Averages", index=True)
-            return output.getvalue()
+        st.dataframe(avg_per_source, use_container_width=True)
+
+        # Downloads (filtered to current year/period); serialized once per data version, period and sort
+        master_export = master_year.drop(columns=["batch_id", "year", "month_num"], errors="ignore")
 
         col1, col2, col3 = st.columns(3)
         with col1:
             st.download_button(
                 "⬇️ Download Pivot (CSV)",
-                data=pivot_view.to_csv().encode("utf-8"),
+                data=to_csv_bytes(period + (sort_choice, ascending), pivot_view),
                 file_name=f"referral_pivot_{year_choice}{'_YTD' if use_ytd else ''}.csv",
                 mime="text/csv"
             )
         with col2:
             st.download_button(
                 "⬇️ Download Master (CSV)",
-                data=master_year.drop(columns=["batch_id"], errors="ignore").to_csv(index=False).encode("utf-8"),
+                data=to_csv_bytes(period, master_export, index=False),
                 file_name=f"referrals_master_{year_choice}{'_YTD' if use_ytd else ''}.csv",
                 mime="text/csv"
             )
         with col3:
-            excel_bytes = to_excel_bytes(
-                pivot_view,
-                master_year.drop(columns=["batch_id"], errors="ignore"),
-                avg_per_source_sorted
-            )
-            st.download_button(
-                "⬇️ Download Excel (Pivot+Master+Averages)",
-                data=excel_bytes,
-                file_name=f"referrals_report_{year_choice}{'_YTD' if use_ytd else ''}.xlsx",
-                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-            )
+            # st.download_button needs the bytes up front (no lazy `data` in Streamlit 1.36),
+            # so the workbook is only built once asked for, for the exact data, period and sort
+            # it was asked for; any change hides the button until the next click
+            excel_key = period + (sort_choice, ascending)
+            if st.button("📊 Prepare Excel (Pivot+Master+Averages)", key="prepare_excel_btn"):
+                st.session_state["excel_key"] = excel_key
+            if st.session_state.get("excel_key") == excel_key:
+                st.download_button(
+                    "⬇️ Download Excel (Pivot+Master+Averages)",
+                    data=to_excel_bytes(excel_key, pivot_view, master_export, avg_per_source),
+                    file_name=f"referrals_report_{year_choice}{'_YTD' if use_ytd else ''}.xlsx",
+                    mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+                )
 
 # ---------- Row editor (surgical deletes) ----------
 st.header("3) Edit / Delete Specific Rows")
-master = load_master()
 
 if len(master) == 0:
     st.info("No data yet.")
@@ -379,10 +711,11 @@ else:
     # Filters
     col_f1, col_f2, col_f3 = st.columns([1, 1, 2])
     with col_f1:
-        months_all = sorted([m for m in master["month"].dropna().unique()])
+        # Typing in the person filter reruns the page; these lists only change with the data
+        months_all = distinct_values(master_mtime(), "month")
         month_filter = st.selectbox("Month", ["(All)"] + months_all, index=0)
     with col_f2:
-        sources_all = sorted([s for s in master["referral_source"].dropna().unique()])
+        sources_all = distinct_values(master_mtime(), "referral_source")
         source_filter = st.multiselect("Referral source(s)", sources_all, default=[])
     with col_f3:
         person_query = st.text_input("Filter by referred person (contains)", value="")
@@ -394,9 +727,10 @@ else:
     if source_filter:
         mask &= master["referral_source"].isin(source_filter)
     if person_query.strip():
-        mask &= master["referred_person"].astype(str).str.contains(person_query.strip(), case=False, na=False)
+        # Plain substring match, case-folded inside Arrow's kernel (referred_person is string[pyarrow])
+        mask &= master["referred_person"].str.contains(person_query.strip(), case=False, regex=False, na=False)
 
-    edit_df = master.loc[mask].copy()
+    edit_df = master.loc[mask].drop(columns=["year", "month_num"])
     if edit_df.empty:
         st.info("No rows match your filters.")
     else:
@@ -425,11 +759,11 @@ else:
                     st.error("Internal error: 'Delete?' column not found.")
                     st.stop()
 
-                # Build a per-row boolean mask; fill NAs as False just in case
-                delete_mask = edited["Delete?"].fillna(False).astype(bool)
+                # One contiguous bool buffer (NAs count as unchecked) and a plain ndarray index
+                delete_mask = edited["Delete?"].to_numpy(dtype=bool, na_value=False)
 
                 # Get the original row indices corresponding to the checked rows
-                to_delete_idx = edited.index[delete_mask]
+                to_delete_idx = edited.index.to_numpy()[delete_mask]
 
                 if len(to_delete_idx) == 0:
                     st.warning("No rows were checked for deletion.")